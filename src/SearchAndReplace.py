@@ -1,4 +1,130 @@
-def compile(pattern,groupmap=None):
+# Regex engines that can be used to compile patterns. Each name is the module
+# that is imported to provide the compile function. 're' is always available;
+# 'regex' and 're2' (a linear time engine) are used only when installed.
+REGEX_BACKENDS = ('re','regex','re2')
+
+_default_backend = 're'
+
+# The imported module for each backend name, or None if it isn't installed.
+# Each backend is only imported once.
+_backend_modules = {}
+
+try:
+  _string_types = basestring
+except NameError:
+  _string_types = str
+
+def GetRegexBackend(backend=None):
+  """
+  Get the module used to compile regex patterns.
+
+  backend - The name of a backend from REGEX_BACKENDS, or a module that has
+            a compile function. If None, the default backend is returned
+            (see SetRegexBackend). If the default is a tuple of names, the
+            first one that is installed is returned.
+
+  Raises ValueError for an unknown backend name, and ImportError if the
+  backend module is not installed.
+  """
+  if backend is None: backend = _default_backend
+  if isinstance(backend,tuple):
+    for name in backend:
+      if IsBackendAvailable(name): return GetRegexBackend(name)
+    raise ImportError("None of the regex backends %s are installed" % (backend,))
+  if not isinstance(backend,_string_types):
+    if not hasattr(backend,'compile'):
+      raise ValueError("Regex backend %r has no compile function" % (backend,))
+    return backend
+  if backend not in REGEX_BACKENDS:
+    raise ValueError("Unknown regex backend '%s'. Use one of %s" % \
+                     (backend,", ".join(REGEX_BACKENDS)))
+  backend = str(backend)
+  if backend not in _backend_modules:
+    try:
+      _backend_modules[backend] = __import__(backend)
+    except ImportError:
+      _backend_modules[backend] = None
+  module = _backend_modules[backend]
+  if module is None:
+    raise ImportError("The regex backend '%s' is not installed" % backend)
+  return module
+
+def SetRegexBackend(backend):
+  """
+  Set the default backend used to compile patterns when no backend is passed
+  to compile, PatternDecorator, RegexReplacer or ReplacerSwitch.
+
+  backend - The name of a backend from REGEX_BACKENDS, or a tuple of names in
+            order of preference (see PatternDecorator). Each name in a tuple
+            must be known, and at least one must be installed.
+  """
+  global _default_backend
+  if isinstance(backend,tuple):
+    for name in backend:
+      if isinstance(name,tuple):
+        raise ValueError("Regex backend tuples can't be nested")
+      try:
+        GetRegexBackend(name)
+      except ImportError:
+        pass
+  GetRegexBackend(backend)
+  _default_backend = backend
+
+def IsBackendAvailable(backend):
+  """
+  Return True if the named backend is known and installed.
+  """
+  try:
+    GetRegexBackend(backend)
+  except (ValueError,ImportError):
+    return False
+  return True
+
+def CompatiblePatterns(patterns,backend):
+  """
+  Return the patterns from the list that the backend is able to compile. This
+  can be used to find which rules are able to use a faster engine. If the
+  backend is not installed, an empty list is returned. Some re2 bindings
+  quietly compile unsupported patterns with re instead. Patterns that come
+  back as re pattern objects are not counted as compatible.
+
+  patterns - A list of regex pattern strings.
+  backend  - The name of a backend from REGEX_BACKENDS.
+  """
+  import re
+  if not IsBackendAvailable(backend): return []
+  module = GetRegexBackend(backend)
+  re_pattern = type(re.compile(''))
+  compatible = []
+  for pattern in patterns:
+    try:
+      compiled = module.compile(pattern)
+    except Exception:
+      continue
+    if module is not re and isinstance(compiled,re_pattern): continue
+    compatible.append(pattern)
+  return compatible
+
+def _compile_pattern(pattern,backend=None):
+  """
+  Compile a pattern string with the backend. The backend may also be a tuple
+  of backend names in order of preference. In that case the first backend
+  that is installed and able to compile the pattern is used.
+  """
+  if backend is None: backend = _default_backend
+  if not isinstance(backend,tuple):
+    return GetRegexBackend(backend).compile(pattern)
+  error = None
+  for name in backend:
+    if not IsBackendAvailable(name): continue
+    try:
+      return GetRegexBackend(name).compile(pattern)
+    except Exception as e:
+      error = e
+  if error is not None: raise error
+  raise ImportError("None of the regex backends %s are installed" % (backend,))
+
+def compile(pattern,groupmap=None,backend=None):
   """
   Similar to the re.compile. However, methods that return Match
   objects or iterators can be passed a groupmap to override the groups
@@ -10,8 +136,10 @@ def compile(pattern,groupmap=None):
   pattern  - The regex pattern
   groupmap - A default groupmap to override group values from the Match
              objects.
+  backend  - The regex backend used to compile the pattern. See
+             PatternDecorator.
   """
-  return PatternDecorator(pattern,groupmap)
+  return PatternDecorator(pattern,groupmap,backend)
 
 class PatternDecorator:
   """
@@ -23,15 +151,18 @@ class PatternDecorator:
   function that takes a MatchObject and returns a string.
   """
 
-  def __init__(self,pattern, groupmap=None):
+  def __init__(self,pattern, groupmap=None, backend=None):
     """
     pattern  - A regular expression pattern string, or a pattern object.
     groupmap - A default groupmap to use. This overrides the group values
                that come from a match. See MatchOverride.group.
+    backend  - The regex backend used to compile a pattern string. This is a
+               name from REGEX_BACKENDS, or a tuple of names in order of
+               preference where the first backend that can compile the
+               pattern is used. The default is set by SetRegexBackend.
     """
     if isinstance(pattern,str):
-      import re
-      self._pattern = re.compile(pattern)
+      self._pattern = _compile_pattern(pattern,backend)
     else:
       self._pattern = pattern
     self.groupmap = groupmap
@@ -239,19 +370,388 @@ class MatchOverride:
     if line is None: line = self.string
     return line[0:s] + self.expand(template) + line[e:]
 
+class RuleTimeout(Exception):
+  """
+  Raised when a replacer takes longer than the time budget to process a line.
+  """
+  pass
+
+class _RuleTimer:
+  """
+  Limits the time spent in each call made through Call to the time budget.
+  Where possible (Unix, in the main thread) a repeating interval timer is
+  started once by Start, and its signal handler interrupts a call that is past
+  its deadline, so a pattern with catastrophic backtracking is stopped early.
+  Otherwise each call runs to the end and the elapsed time is checked
+  afterwards. Stop restores the signal handler and any interval timer that
+  was already running.
+  """
+
+  # The number of timer signals per budget. A call is interrupted at most
+  # budget/TICKS seconds after its deadline.
+  TICKS = 4
+
+  def __init__(self,budget):
+    """
+    budget - The maximum time in seconds for each call.
+    """
+    import time
+    self.budget    = budget
+    self.deadline  = None
+    self.running   = False
+    self.use_timer = False
+    self._time     = time.time
+
+  def Start(self):
+    import signal, threading
+    self.use_timer = hasattr(signal,'setitimer') and \
+                     isinstance(threading.current_thread(),threading._MainThread)
+    if not self.use_timer: return
+    self.started          = self._time()
+    self.previous_handler = signal.signal(signal.SIGALRM,self.__Expired__)
+    tick = self.budget / self.TICKS
+    self.previous_timer   = signal.setitimer(signal.ITIMER_REAL,tick,tick)
+
+  def __Expired__(self,signum,frame):
+    # Only interrupt a call that is running inside Call. Clearing the flag
+    # before raising means at most one RuleTimeout is raised per call, and
+    # always from inside Call, where the caller catches it.
+    if self.running and self._time() > self.deadline:
+      self.running = False
+      raise RuleTimeout()
+
+  def Call(self,function,*args):
+    """
+    Call a function, and raise RuleTimeout if it takes longer than the
+    budget.
+    """
+    try:
+      deadline = self.deadline = self._time() + self.budget
+      self.running = True
+      result = function(*args)
+    finally:
+      self.running = False
+    if self._time() > deadline: raise RuleTimeout()
+    return result
+
+  def Stop(self):
+    import signal
+    if not self.use_timer: return
+    # Disarm the timer before anything else so no further signals arrive.
+    signal.setitimer(signal.ITIMER_REAL,0)
+    self.use_timer = False
+    self.running   = False
+    handler = self.previous_handler
+    if handler is None: handler = signal.SIG_DFL
+    signal.signal(signal.SIGALRM,handler)
+    delay,interval = self.previous_timer
+    if delay > 0:
+      # Fire a timer that came due while this one was running right away.
+      delay = max(delay - (self._time() - self.started),1e-6)
+      signal.setitimer(signal.ITIMER_REAL,delay,interval)
+
+def _ReplaceTimed(replacer,line,timer):
+  """
+  Apply a replacer with each of its rules limited by the timer. Replacers that
+  define DoReplaceTimed limit each rule separately. Other replacers and
+  functions are limited as a whole.
+
+  Returns a tuple (line, skipped), where skipped is a list of the rules that
+  ran out of time.
+  """
+  if hasattr(replacer,'DoReplaceTimed'):
+    return replacer.DoReplaceTimed(line,timer)
+  try:
+    return (timer.Call(replacer,line),[])
+  except RuleTimeout:
+    return (line,[replacer])
+
+def _ToBytes(text):
+  """
+  Encode text as UTF-8 for a RuleTable. Byte strings (str on Python 2) are
+  stored as they are.
+  """
+  if isinstance(text,bytes): return text
+  return text.encode('utf-8')
+
+def _FromBytes(data):
+  """
+  Convert data read from a RuleTable to the string type the replacers work
+  with. On Python 2 this is the byte string as it was stored. On Python 3 it
+  is decoded from UTF-8.
+  """
+  if bytes is str: return data
+  return data.decode('utf-8')
+
+def _AsLineType(data,line):
+  """
+  Convert data read from a RuleTable to the string type of line, so the two
+  can be used together in str.replace.
+  """
+  if isinstance(line,bytes): return data
+  return data.decode('utf-8')
+
+def WriteRuleTable(filename,pairs):
+  """
+  Write replacement pairs to a RuleTable file. The file holds a header, the
+  distinct key lengths, an array of offsets, a hash index of the keys and the
+  UTF-8 encoded keys and values packed one after the other, so it can be
+  memory mapped and shared by several processes. Unicode strings are encoded
+  as UTF-8. Byte strings are stored unchanged.
+
+  filename - The name of the file to write.
+  pairs    - A dictionary of key value pairs, or a list of (key, value) tuples.
+             The order of the pairs is kept.
+  """
+  import struct, zlib
+  if hasattr(pairs,'items'): pairs = pairs.items()
+  offsets = [0]
+  chunks  = []
+  keys    = []
+  for (key,value) in pairs:
+    key = _ToBytes(key)
+    keys.append(key)
+    for data in (key,_ToBytes(value)):
+      chunks.append(data)
+      offsets.append(offsets[-1]+len(data))
+  count   = len(keys)
+  lengths = sorted(set(len(key) for key in keys))
+
+  # An open addressing hash table of (crc32 of key, pair index + 1) entries.
+  # It is kept at most half full. Zero marks an empty bucket.
+  nbuckets = 1
+  while nbuckets < 2*count: nbuckets *= 2
+  buckets = [0]*(2*nbuckets)
+  for (index,key) in enumerate(keys):
+    h = zlib.crc32(key) & 0xffffffff
+    b = h & (nbuckets-1)
+    while buckets[2*b+1] != 0:
+      b = (b+1) & (nbuckets-1)
+    buckets[2*b]   = h
+    buckets[2*b+1] = index+1
+
+  out = open(filename,'wb')
+  out.write(struct.pack(RuleTable.HEADER,RuleTable.MAGIC,RuleTable.VERSION,
+                        count,nbuckets,len(lengths)))
+  out.write(struct.pack('<%dI' % len(lengths),*lengths))
+  out.write(struct.pack('<%dQ' % len(offsets),*offsets))
+  out.write(struct.pack('<%dI' % len(buckets),*buckets))
+  for data in chunks:
+    out.write(data)
+  out.close()
+
+class RuleTable:
+  """
+  A read only table of replacement pairs loaded from a file written by
+  WriteRuleTable. The file is memory mapped rather than read into Python
+  objects, so worker processes that load the same file share its pages, and
+  pickling a table only passes the file name. A RuleTable can be passed to
+  SimpleReplacer or RegexReplacer in place of a dictionary.
+
+  The pairs stay in the file. They are read as they are used, and are not
+  kept. The file has a hash index of the keys, so Replace only reads the
+  pairs whose key occurs in the line. Its cost depends on the length of the
+  line and the number of distinct key lengths, not on the size of the table.
+  Keys and values are byte strings (str) on Python 2, and str decoded from
+  UTF-8 on Python 3.
+  """
+
+  MAGIC   = b'SRRT'
+  VERSION = 2
+  HEADER  = '<4sIIII'
+
+  def __init__(self,filename):
+    """
+    filename - The name of a file written by WriteRuleTable.
+    """
+    self.filename = filename
+    self.__Open__()
+
+  def __Open__(self):
+    import mmap, struct
+    f = open(self.filename,'rb')
+    try:
+      self._map = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+    finally:
+      f.close()
+    header = struct.calcsize(self.HEADER)
+    if len(self._map) < header:
+      magic,version = None,None
+    else:
+      magic,version,count,nbuckets,nlengths = \
+        struct.unpack_from(self.HEADER,self._map,0)
+    if magic != self.MAGIC or version != self.VERSION:
+      self._map.close()
+      raise ValueError("'%s' is not a version %d rule table" % \
+                       (self.filename,self.VERSION))
+    self.count     = count
+    self._nbuckets = nbuckets
+    self._lengths  = struct.unpack_from('<%dI' % nlengths,self._map,header)
+    self._offsets  = header + 4*nlengths
+    self._buckets  = self._offsets + 8*(2*count+1)
+    self._data     = self._buckets + 8*nbuckets
+    self._entry    = struct.Struct('<II').unpack_from
+    self._span     = struct.Struct('<3Q').unpack_from
+
+  def __getstate__(self):
+    return {'filename':self.filename}
+
+  def __setstate__(self,state):
+    self.filename = state['filename']
+    self.__Open__()
+
+  def __len__(self):
+    return self.count
+
+  def __iter__(self):
+    for (key,value) in self.items():
+      yield key
+
+  def __contains__(self,key):
+    return self.__Find__(_ToBytes(key),-1,set())
+
+  def __RawPair__(self,index):
+    """
+    Return the (key, value) tuple at an index as the stored UTF-8 bytes.
+    """
+    start,middle,end = self._span(self._map,self._offsets+16*index)
+    data = self._data
+    return (self._map[data+start:data+middle],self._map[data+middle:data+end])
+
+  def __Find__(self,key,after,found):
+    """
+    Add the indexes of the pairs after the given index whose key is the byte
+    string key to the found set. Returns True if any were added.
+    """
+    import zlib
+    h    = zlib.crc32(key) & 0xffffffff
+    mask = self._nbuckets - 1
+    b    = h & mask
+    added = False
+    while True:
+      bh,slot = self._entry(self._map,self._buckets+8*b)
+      if slot == 0: return added
+      if bh == h and slot-1 > after and self.__RawPair__(slot-1)[0] == key:
+        found.add(slot-1)
+        added = True
+      b = (b+1) & mask
+
+  def __Scan__(self,data,after):
+    """
+    Return the set of indexes after the given index of the pairs whose key
+    occurs in the byte string data.
+    """
+    found = set()
+    size  = len(data)
+    for length in self._lengths:
+      if length > size: break
+      if length == 0:
+        self.__Find__(b'',after,found)
+        continue
+      for i in range(size-length+1):
+        self.__Find__(data[i:i+length],after,found)
+    return found
+
+  def Replace(self,line):
+    """
+    Apply each pair to the line in order, in the same way as SimpleReplacer
+    does with a dictionary. Only the pairs whose key occurs in the line are
+    read from the file. After a pair changes the line, the line is scanned
+    again, since the new text may contain keys of later pairs.
+
+    line - The line of text to modify.
+    """
+    after = -1
+    found = self.__Scan__(_ToBytes(line),after)
+    while found:
+      index = min(found)
+      found.discard(index)
+      key,value = self.__RawPair__(index)
+      replaced  = line.replace(_AsLineType(key,line),_AsLineType(value,line))
+      after = index
+      if replaced != line:
+        line  = replaced
+        found = self.__Scan__(_ToBytes(line),after)
+    return line
+
+  def Pair(self,index):
+    """
+    Return the (key, value) tuple at an index.
+    """
+    if index < 0: index += self.count
+    if not 0 <= index < self.count: raise IndexError("Pair index out of range")
+    key,value = self.__RawPair__(index)
+    return (_FromBytes(key),_FromBytes(value))
+
+  def items(self):
+    for index in range(self.count):
+      yield self.Pair(index)
+
+  def keys(self):
+    return list(self)
+
+  def values(self):
+    return [value for (key,value) in self.items()]
+
+  def Close(self):
+    """
+    Release the memory map. The table can't be used after it is closed.
+    """
+    self._map.close()
+
 class Replacer:
   """
   This is the base interface for a Replacer. A Replacer should be able to be
   called as a function that receives the line and writes out a modified line
   of text. If None is passed back, nothing is writen to the output.
+
+  A replacer is stateless if its result depends only on the line passed in.
+  Stateless replacers may process repeated values only once. Subclasses that
+  keep no state between lines should set stateless to True.
   """
 
+  stateless = False
+
   def DoReplace(self,line):
     """
     This is a dummy implementation that just passes back what was passed in.
     """
     return line
 
+  def DoReplaceTimed(self,line,timer):
+    """
+    Modify a line with each rule limited by a time budget (see
+    SearchAndReplace). A rule that runs out of time is skipped for the line.
+    This implementation treats the whole replacer as a single rule.
+
+    line  - The line of text to modify.
+    timer - Used to call each rule with a time limit.
+
+    Returns a tuple (line, skipped), where skipped is a list of the rules that
+    ran out of time.
+    """
+    try:
+      return (timer.Call(self.DoReplace,line),[])
+    except RuleTimeout:
+      return (line,[self])
+
+  def ReplaceMany(self,values):
+    """
+    Apply the replacer to each string in values, and return a list of the
+    results in the same order. For stateless replacers each distinct value is
+    only processed once.
+
+    values - An iterable of strings (e.g. a list, or a column of values).
+    """
+    if not self.stateless:
+      return [self(value) for value in values]
+    results = {}
+    replaced = []
+    for value in values:
+      if value not in results: results[value] = self(value)
+      replaced.append(results[value])
+    return replaced
+
   def __call__(self,line):
     """
     Enable a replacer to be called as a function. The function should recieve
@@ -265,10 +765,16 @@ class SimpleReplacer(Replacer):
   Simple string value replacement based on key value pairs.
   """
 
+  stateless = True
+
+  # Separator used to join values so all of them can be replaced in one pass.
+  SEPARATOR = "\0"
+
   def __init__(self,pairs=None):
     """
     pairs - A dictionary of replacement values. The value to replace is the key,
-            and its value is the new value to use.
+            and its value is the new value to use. This may also be a
+            RuleTable.
     """
     if pairs is not None:
       self.replace = pairs
@@ -282,25 +788,62 @@ class SimpleReplacer(Replacer):
     val    - A substring to replace
     newval - The replacement value
     """
+    # A RuleTable is read only, so copy it to a dictionary first.
+    if isinstance(self.replace,RuleTable):
+      self.replace = dict(self.replace.items())
     self.replace[val] = newval
 
   def DoReplace(self,line):
+    if isinstance(self.replace,RuleTable):
+      return self.replace.Replace(line)
     for (val,newval) in self.replace.items():
       line = line.replace(val,newval)
     return line
 
+  def ReplaceMany(self,values):
+    """
+    Apply the replacement pairs to each string in values, and return a list of
+    the results. The distinct values are joined with SEPARATOR so that each
+    pair is applied once to the whole batch. If the separator appears in a
+    value or a pair, the values are processed one at a time. The values are
+    also processed one at a time for a RuleTable, which only reads the pairs
+    that occur in each value.
+
+    values - An iterable of strings.
+    """
+    values = list(values)
+    if isinstance(self.replace,RuleTable):
+      return Replacer.ReplaceMany(self,values)
+    sep    = self.SEPARATOR
+    unique = list(set(values))
+    for text in unique + [t for pair in self.replace.items() for t in pair]:
+      if sep in text: return Replacer.ReplaceMany(self,values)
+    # An empty key would also match on either side of the separator.
+    if '' in self.replace: return Replacer.ReplaceMany(self,values)
+
+    replaced = self.DoReplace(sep.join(unique)).split(sep)
+    results  = dict(zip(unique,replaced))
+    return [results[value] for value in values]
+
 class RegexReplacer(Replacer):
   """
   This recieves a set of regex replacement / substition pairs and applies the
   pairs to the lines that are passed in.
   """
 
-  def __init__(self,pairs=None):
+  stateless = True
+
+  def __init__(self,pairs=None,backend=None):
     """
-    pairs - A dictionary of pattern and substitution values. The pattern is the
-            key value.
+    pairs   - A dictionary of pattern and substitution values. The pattern is
+              the key value. This may also be a RuleTable, in which case the
+              patterns are compiled from the table when it is loaded.
+    backend - The regex backend used to compile the patterns. See
+              PatternDecorator.
     """
-    self.replace = {}
+    self.backend  = backend
+    self.replace  = {}
+    self.patterns = {}
     if pairs is not None:
       for (k,v) in pairs.items():
         self.AddRegexPair(k,v)
@@ -314,19 +857,41 @@ class RegexReplacer(Replacer):
                   sub(template,line)
                This takes a re.sub template string and a line and returns the
                modified line.
-    template - The substitution string associated with the pattern
+    template - The substitution string associated with the pattern. Like
+               re.sub, this may also be a function that takes a match object
+               and returns the replacement string.
+
+    A function passed as the pattern or the template may keep state between
+    lines, so the replacer is no longer treated as stateless (see Replacer)
+    unless the function has a stateless attribute set to True.
     """
-    import re
+    for rule in (pattern,template):
+      if callable(rule) and not getattr(rule,'stateless',False):
+        self.stateless = False
     if callable(pattern):
       self.replace[template] = pattern
     else:
-      self.replace[template] = re.compile(pattern).sub
+      self.replace[template] = _compile_pattern(pattern,self.backend).sub
+    self.patterns[template] = pattern
 
   def DoReplace(self,line):
     for (template,sub) in self.replace.items():
       line = sub(template,line)
     return line
 
+  def DoReplaceTimed(self,line,timer):
+    """
+    Apply each pattern with its own time limit. A pattern that runs out of
+    time is skipped, and is returned in the skipped list.
+    """
+    skipped = []
+    for (template,sub) in self.replace.items():
+      try:
+        line = timer.Call(sub,template,line)
+      except RuleTimeout:
+        skipped.append(self.patterns[template])
+    return (line,skipped)
+
 class ReplacerSwitch(Replacer):
   """
   A ReplacerSwitch object is used to select an active replacer. Each replacer
@@ -339,7 +904,8 @@ class ReplacerSwitch(Replacer):
   SWITCH   = "SWITCH"
   REPLACER = "REPLACER"
 
-  def __init__(self, default_replacer=None, constructs=None, switch_line_check=True):
+  def __init__(self, default_replacer=None, constructs=None, switch_line_check=True,
+               backend=None):
     """
     default_replacer  - This is the default replacer to use until a case matches.
                         If none is specified, the string that comes in is
@@ -351,7 +917,11 @@ class ReplacerSwitch(Replacer):
 
     switch_line_check - Switch Line Check - Use the replacer on the lines that
                         match the switch conditions. Default is True.
+
+    backend           - The regex backend used to compile switch rule
+                        patterns. See PatternDecorator.
     """
+    self.backend           = backend
     self.switches          = []
     self.default           = default_replacer
     self.current_replacer  = default_replacer
@@ -373,11 +943,10 @@ class ReplacerSwitch(Replacer):
     replacer    - This is a function which recieves a string and returns a
                   modified string.
     """
-    import re
     switch = {}
     # Convert a string match pattern into a switch to test
     if isinstance(switch_rule,str) == True:
-      switch_rule    = re.compile(switch_rule).search
+      switch_rule    = _compile_pattern(switch_rule,self.backend).search
     switch[self.SWITCH]   = switch_rule
     switch[self.REPLACER] = replacer
     self.switches.append(switch)
@@ -397,6 +966,114 @@ class ReplacerSwitch(Replacer):
         break
     return self.current_replacer(line)
 
+  def DoReplaceTimed(self,line,timer):
+    """
+    Modify a line with each switch rule, and the rules of the active
+    replacer, limited by a time budget. A switch rule that runs out of time
+    is treated as not matching, so the active replacer only changes when a
+    switch rule finishes in time.
+    """
+    skipped = []
+    for switch in self.switches:
+      try:
+        found = timer.Call(switch[self.SWITCH],line) is not None
+      except RuleTimeout:
+        skipped.append(switch[self.SWITCH])
+        continue
+      if found:
+        self.current_replacer = switch[self.REPLACER]
+        if not self.switch_line_check:
+          return (line,skipped)
+        break
+    line,rules = _ReplaceTimed(self.current_replacer,line,timer)
+    return (line,skipped+rules)
+
+class CachingReplacer(Replacer):
+  """
+  A CachingReplacer applies a chain of stateless replacers, and remembers the
+  results for the most recently used lines. Repeated lines are returned from
+  the cache instead of running every replacer again. Only replacers with
+  stateless set to True may be cached, since a stateful replacer (such as a
+  ReplacerSwitch) may return a different value for the same line.
+
+  The cache isn't told when a replacer in the chain changes. After a pair is
+  added with SimpleReplacer.AddPair or RegexReplacer.AddRegexPair, call Clear
+  or the cache will return results from before the change.
+  """
+
+  stateless = True
+
+  def __init__(self,replacers,maxsize=1024):
+    """
+    replacers - A Replacer, or a sequence of replacers that are applied in
+                order. The sequence is copied, so replacers added to it later
+                are not used.
+    maxsize   - The maximum number of lines to keep in the cache. The least
+                recently used line is dropped when the cache is full.
+    """
+    from collections import OrderedDict
+    if callable(replacers):
+      replacers = [replacers]
+    else:
+      replacers = list(replacers)
+    for replacer in replacers:
+      if not getattr(replacer,'stateless',False):
+        raise ValueError("Replacer %r is not stateless and can't be cached" % \
+                         (replacer,))
+    self.replacers = replacers
+    self.maxsize   = maxsize
+    self.cache     = OrderedDict()
+    self.hits      = 0
+    self.misses    = 0
+
+  def Lookup(self,line):
+    """
+    Look up a line in the cache, and mark it as the most recently used.
+
+    Returns a tuple (found, value).
+    """
+    if line not in self.cache:
+      self.misses += 1
+      return (False,None)
+    self.hits += 1
+    value = self.cache.pop(line)
+    self.cache[line] = value
+    return (True,value)
+
+  def Store(self,line,value):
+    """
+    Add the replaced value for a line to the cache.
+    """
+    if self.maxsize <= 0: return
+    if line in self.cache:
+      del self.cache[line]
+    elif len(self.cache) >= self.maxsize:
+      self.cache.popitem(False)
+    self.cache[line] = value
+
+  def Clear(self):
+    """
+    Remove all lines from the cache. The hit and miss counts are kept.
+    """
+    self.cache.clear()
+
+  def HitRate(self):
+    """
+    Return the fraction of lookups that were found in the cache.
+    """
+    total = self.hits + self.misses
+    if total == 0: return 0.0
+    return float(self.hits) / total
+
+  def DoReplace(self,line):
+    found,value = self.Lookup(line)
+    if found: return value
+    value = line
+    for replacer in self.replacers:
+      value = replacer(value)
+    self.Store(line,value)
+    return value
+
 class SearchAndReplace:
   """
   This class is used to do search and replace on strings or files. For files,
@@ -406,8 +1083,29 @@ class SearchAndReplace:
 
   EVT_FINISHED = "FINISHED"
 
-  def __init__(self, replacers=None):
-    self.listeners = []
+  STAT_SKIPPED = "SKIPPED"
+
+  def __init__(self, replacers=None, time_budget=None, cache_size=None):
+    """
+    replacers   - A list of Replacer objects or functions that take a line and
+                  return a line.
+    time_budget - The maximum time in seconds a single rule may spend on a
+                  line. A rule is a pattern of a RegexReplacer, a switch rule
+                  of a ReplacerSwitch, or a whole replacer that has no
+                  DoReplaceTimed method. If a rule takes longer, it is skipped
+                  for that line and a (line number, replacer, rule) tuple is
+                  recorded in stats[STAT_SKIPPED]. Default is None (no limit).
+    cache_size  - The number of lines to cache results for (see
+                  CachingReplacer). The cache is only used when every replacer
+                  is stateless, and is rebuilt for each file or string that is
+                  processed. The cache from the last run is kept in cache.
+                  Default is None (no cache).
+    """
+    self.listeners   = []
+    self.time_budget = time_budget
+    self.cache_size  = cache_size
+    self.cache       = None
+    self.stats       = {self.STAT_SKIPPED:[]}
     if replacers is None:
       self.replacers = []
     else:
@@ -425,6 +1123,53 @@ class SearchAndReplace:
   def GetReplacers(self):
     return self.replacers
 
+  def ReplaceMany(self,values):
+    """
+    Apply the replacers to each string in values, and return a list of the
+    results in the same order. Each replacer is given the whole batch at once
+    (see Replacer.ReplaceMany), which avoids a function call per value and
+    replacer. Values that a replacer turns into None are left as None and are
+    not passed to the following replacers.
+
+    If a time budget is set, each value is passed to the replacers one at a
+    time with the same limit as DoReplace, and stats[STAT_SKIPPED] records the
+    position of the value (starting at 1) in place of the line number.
+
+    values - An iterable of strings (e.g. a list, or a column of values).
+    """
+    results = list(values)
+    timer = None
+    if self.time_budget is not None:
+      self.stats[self.STAT_SKIPPED] = []
+      timer = _RuleTimer(self.time_budget)
+      timer.Start()
+    try:
+      for replacer in self.GetReplacers():
+        indexes = [i for (i,value) in enumerate(results) if value is not None]
+        batch   = [results[i] for i in indexes]
+        if timer is not None:
+          batch = [self.__ReplaceTimed__(replacer,results[i],i+1,timer) \
+                   for i in indexes]
+        elif hasattr(replacer,'ReplaceMany'):
+          batch = replacer.ReplaceMany(batch)
+        else:
+          batch = [replacer(value) for value in batch]
+        for (i,value) in zip(indexes,batch):
+          results[i] = value
+    finally:
+      if timer is not None: timer.Stop()
+    return results
+
+  def __ReplaceTimed__(self,replacer,line,lineno,timer):
+    """
+    Apply a replacer to a line with the time budget, and record the rules
+    that were skipped in stats[STAT_SKIPPED].
+    """
+    line,rules = _ReplaceTimed(replacer,line,timer)
+    for rule in rules:
+      self.stats[self.STAT_SKIPPED].append((lineno,replacer,rule))
+    return line
+
   def AddListener(self,listener):
     """
     Add an event listener. The event is a string value. Event strings are
@@ -480,11 +1225,58 @@ class SearchAndReplace:
     lines - an iterator that holds the lines to process.
     out   - a file like stream to write values to.
     """
-    for (i,line) in enumerate(lines):
-      for DoReplace in self.GetReplacers():
-        line = DoReplace(line)
-      # Don't write out the line if we get None back.
-      if line is not None: print >>out, line,
+    self.stats[self.STAT_SKIPPED] = []
+    self.cache = None
+    replacers = self.GetReplacers()
+    if self.cache_size and \
+       all(getattr(replacer,'stateless',False) for replacer in replacers):
+      self.cache = CachingReplacer(replacers,self.cache_size)
+    timer = None
+    if self.time_budget is not None:
+      timer = _RuleTimer(self.time_budget)
+      timer.Start()
+    try:
+      for (i,line) in enumerate(lines):
+        line = self.__ReplaceLine__(line,i+1,timer)
+        # Don't write out the line if we get None back.
+        if line is not None: print >>out, line,
+    finally:
+      if timer is not None: timer.Stop()
 
     for listener in self.listeners:
       listener(self.EVT_FINISHED, out)
+
+  def __ReplaceLine__(self, line, lineno, timer=None):
+    """
+    Apply the replacers to a single line. If a time budget is set, a rule
+    that exceeds it is skipped for this line, and a (lineno, replacer, rule)
+    tuple is added to stats[STAT_SKIPPED]. If a cache is active, repeated lines
+    are taken from it. Lines where a rule was skipped are not cached.
+
+    line   - The line of text to modify.
+    lineno - The line number (starting at 1) used when recording stats.
+    timer  - A started _RuleTimer for the time budget. If this is None and a
+             time budget is set, a timer is started for this line.
+    """
+    if self.time_budget is not None and timer is None:
+      timer = _RuleTimer(self.time_budget)
+      timer.Start()
+      try:
+        return self.__ReplaceLine__(line,lineno,timer)
+      finally:
+        timer.Stop()
+
+    if self.cache is not None:
+      found,value = self.cache.Lookup(line)
+      if found: return value
+    original = line
+    skipped  = self.stats[self.STAT_SKIPPED]
+    nskipped = len(skipped)
+    for DoReplace in self.GetReplacers():
+      if timer is None:
+        line = DoReplace(line)
+        continue
+      line = self.__ReplaceTimed__(DoReplace,line,lineno,timer)
+    if self.cache is not None and len(skipped) == nskipped:
+      self.cache.Store(original,line)
+    return line
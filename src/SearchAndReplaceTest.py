@@ -19,6 +19,10 @@ class TestReplacer(unittest.TestCase):
     s = "Another Test"
     self.assertEqual(self.r(s),self.r.DoReplace(s))
 
+  def testReplaceMany(self):
+    values = ["a","b","a"]
+    self.assertEqual(values,self.r.ReplaceMany(values))
+
 class TestSimpleReplacer(unittest.TestCase):
 
   def setUp(self):
@@ -34,6 +38,13 @@ class TestSimpleReplacer(unittest.TestCase):
   def testDoReplace(self):
     self.assertEqual("Bob and me",self.r("Robert and I"))
 
+  def testReplaceMany(self):
+    values = ["Robert and I","Robert","Ian","Robert"]
+    self.assertEqual(["Bob and me","Bob","mean","Bob"],self.r.ReplaceMany(values))
+    # Values containing the separator are processed one at a time.
+    values = ["Robert\0I","I"]
+    self.assertEqual(["Bob\0me","me"],self.r.ReplaceMany(values))
+
 class TestRegexReplacer(unittest.TestCase):
 
   def setUp(self):
@@ -48,6 +59,31 @@ class TestRegexReplacer(unittest.TestCase):
   def testDoReplace(self):
     self.assertEqual("_bob_ is a _bot_.",self.r("bob is a bot."))
 
+  def testStateless(self):
+    self.assertTrue(self.r.stateless)
+    self.r.AddRegexPair(lambda template,line: line,"y")
+    self.assertFalse(self.r.stateless)
+    self.assertTrue(SearchAndReplace.RegexReplacer.stateless)
+
+    def marked(template,line):
+      return line
+    marked.stateless = True
+    r = SearchAndReplace.RegexReplacer()
+    r.AddRegexPair(marked,"z")
+    self.assertTrue(r.stateless)
+
+  def testTemplateFunction(self):
+    # A function template may count its calls, so repeated values must each
+    # be replaced.
+    calls = []
+    def counter(match):
+      calls.append(match)
+      return str(len(calls))
+    r = SearchAndReplace.RegexReplacer()
+    r.AddRegexPair("x",counter)
+    self.assertFalse(r.stateless)
+    self.assertEqual(r.ReplaceMany(["x","x","x"]),["1","2","3"])
+
 teststr = \
 """
 Robert and I manage the
@@ -115,6 +151,129 @@ class TestSearchAndReplace(unittest.TestCase):
   def testDoReplaceStr(self):
     self.assertEqual(teststr1,self.s.DoReplaceStr(teststr))
 
+  def testReplaceMany(self):
+    self.s.AddReplacer(lambda line: None if line == "drop" else line + "!")
+    self.s.AddReplacer(SearchAndReplace.RegexReplacer({"(B..)":r"Re\1"}))
+    values = ["Robert","drop","I","Robert"]
+    self.assertEqual(["ReBob!",None,"me!","ReBob!"],self.s.ReplaceMany(values))
+
+class TestTimeBudget(unittest.TestCase):
+
+  def setUp(self):
+    # The backtracking pattern never finishes in a reasonable time on a
+    # long line of a's that doesn't end with an a.
+    slow = SearchAndReplace.RegexReplacer({"(a+)+$":"x","(R)":"r"})
+    fast = SearchAndReplace.SimpleReplacer({'robert':'Bob'})
+    self.slow = slow
+    self.s = SearchAndReplace.SearchAndReplace([slow,fast],0.1)
+
+  def tearDown(self):
+    self.s = None
+
+  def test__ReplaceLine__(self):
+    # Only the slow pattern is skipped. The other pattern is still applied.
+    line = "Robert " + "a"*40 + "!"
+    self.assertEqual(self.s.__ReplaceLine__(line,3),"Bob " + "a"*40 + "!")
+    self.assertEqual(self.s.stats[self.s.STAT_SKIPPED],[(3,self.slow,"(a+)+$")])
+    self.assertEqual(self.s.__ReplaceLine__("Robert aa",4),"Bob x")
+    self.assertEqual(len(self.s.stats[self.s.STAT_SKIPPED]),1)
+
+  def testDoReplaceStr(self):
+    text = "Robert aa\nRobert " + "a"*40 + "!\n"
+    self.assertEqual("Bob x\nBob " + "a"*40 + "!\n",self.s.DoReplaceStr(text))
+    self.assertEqual(self.s.stats[self.s.STAT_SKIPPED],[(2,self.slow,"(a+)+$")])
+
+  def testTimerRestored(self):
+    import signal
+    if not hasattr(signal,'setitimer'): return
+    def handler(signum,frame):
+      pass
+    previous = signal.signal(signal.SIGALRM,handler)
+    signal.setitimer(signal.ITIMER_REAL,5)
+    try:
+      self.s.__ReplaceLine__("Robert " + "a"*40 + "!",1)
+      self.assertTrue(signal.getsignal(signal.SIGALRM) is handler)
+      delay,interval = signal.getitimer(signal.ITIMER_REAL)
+      self.assertTrue(4 < delay <= 5)
+    finally:
+      signal.setitimer(signal.ITIMER_REAL,0)
+      signal.signal(signal.SIGALRM,previous)
+
+  def testTinyBudget(self):
+    # With a budget close to the timer resolution, the timer signals arrive
+    # at every point in the loop. They must never escape as a RuleTimeout,
+    # and the timer must be stopped at the end.
+    import signal
+    self.s.time_budget = 0.00005
+    values = ["Robert aa %d" % i for i in range(20000)]
+    self.assertEqual(len(self.s.ReplaceMany(values)),20000)
+    if hasattr(signal,'getitimer'):
+      self.assertEqual(signal.getitimer(signal.ITIMER_REAL),(0.0,0.0))
+
+  def testReplacerSwitch(self):
+    # A switch rule that runs out of time doesn't change the active replacer.
+    SR = SearchAndReplace.SimpleReplacer
+    switch = SearchAndReplace.ReplacerSwitch(SR({'Robert':'Bob'}),[("(a+)+$",SR({}))])
+    self.s.replacers = [switch]
+    self.assertEqual(self.s.__ReplaceLine__("Robert " + "a"*40 + "!",1),"Bob " + "a"*40 + "!")
+    self.assertEqual(self.s.__ReplaceLine__("Robert",2),"Bob")
+    skipped = self.s.stats[self.s.STAT_SKIPPED]
+    self.assertEqual([(n,r) for (n,r,rule) in skipped],[(1,switch)])
+
+  def testReplaceMany(self):
+    values = ["Robert aa","Robert " + "a"*40 + "!","Robert aa"]
+    self.assertEqual(["Bob x","Bob " + "a"*40 + "!","Bob x"],self.s.ReplaceMany(values))
+    self.assertEqual(self.s.stats[self.s.STAT_SKIPPED],[(2,self.slow,"(a+)+$")])
+
+class TestCachingReplacer(unittest.TestCase):
+
+  def setUp(self):
+    self.calls = []
+    r = SearchAndReplace.SimpleReplacer({'Robert':'Bob'})
+    def count(line):
+      self.calls.append(line)
+      return line
+    count.stateless = True
+    self.r = SearchAndReplace.CachingReplacer([r,count],2)
+
+  def tearDown(self):
+    self.r = None
+
+  def testDoReplace(self):
+    for line in ["Robert","Robert","Bill","Robert","Ann","Bill"]:
+      self.r(line)
+    self.assertEqual(self.r("Robert"),"Bob")
+    # "Bill" was dropped from the cache when "Ann" was added.
+    self.assertEqual(self.calls,["Bob","Bill","Ann","Bill","Bob"])
+    self.assertEqual(self.r.hits,2)
+    self.assertEqual(self.r.misses,5)
+    self.assertAlmostEqual(self.r.HitRate(),2.0/7)
+
+  def testChain(self):
+    SR = SearchAndReplace.SimpleReplacer
+    first = SR({'Robert':'Bob'})
+    r = SearchAndReplace.CachingReplacer((first,SR({'Bob':'Bobby'})))
+    self.assertEqual(r("Robert"),"Bobby")
+    first.AddPair("Bob","Rob")
+    self.assertEqual(r("Robert"),"Bobby")
+    r.Clear()
+    self.assertEqual(r("Robert"),"Rob")
+
+  def testStateless(self):
+    switch = SearchAndReplace.ReplacerSwitch()
+    self.assertRaises(ValueError,SearchAndReplace.CachingReplacer,switch)
+    self.assertRaises(ValueError,SearchAndReplace.CachingReplacer,[lambda l: l])
+    # A function template may keep state, so the replacer can't be cached.
+    r = SearchAndReplace.RegexReplacer()
+    r.AddRegexPair("x",lambda match: "y")
+    self.assertRaises(ValueError,SearchAndReplace.CachingReplacer,r)
+
+  def testSearchAndReplace(self):
+    r = [SearchAndReplace.SimpleReplacer({'Robert':'Bob','I':'me'})]
+    s = SearchAndReplace.SearchAndReplace(r,cache_size=10)
+    self.assertEqual(teststr1+teststr1,s.DoReplaceStr(teststr+teststr))
+    self.assertEqual(s.cache.hits,4)
+
 class TestMatchOverride(unittest.TestCase):
 
   def setUp(self):
@@ -141,6 +300,113 @@ class TestMatchOverride(unittest.TestCase):
     self.assertEqual('_c3_ b2 A(s)', \
           self.mo.insert(r'\3 \2 \1'))
 
+def native(text):
+  """
+  Convert unicode text to the string type the replacers work with: a UTF-8
+  byte string on Python 2, and str on Python 3.
+  """
+  if bytes is str: return text.encode('utf-8')
+  return text
+
+class TestRuleTable(unittest.TestCase):
+
+  def setUp(self):
+    import tempfile, os
+    fd,self.fn = tempfile.mkstemp(".rules")
+    os.close(fd)
+    self.pairs = [('Robert','Bob'),('I','me'),(native(u'caf\xe9'),'cafe')]
+    SearchAndReplace.WriteRuleTable(self.fn,self.pairs)
+    self.table = SearchAndReplace.RuleTable(self.fn)
+
+  def tearDown(self):
+    import os
+    self.table.Close()
+    self.table = None
+    os.remove(self.fn)
+
+  def testPair(self):
+    self.assertEqual(len(self.table),3)
+    self.assertEqual(self.table.Pair(2),self.pairs[2])
+    self.assertEqual(self.table.Pair(-3),self.pairs[0])
+    self.assertRaises(IndexError,self.table.Pair,3)
+    self.assertEqual(list(self.table.items()),self.pairs)
+    self.assertTrue('I' in self.table)
+    self.assertFalse('me' in self.table)
+
+  def testPickle(self):
+    import pickle
+    table = pickle.loads(pickle.dumps(self.table))
+    self.assertEqual(list(table.items()),self.pairs)
+    table.Close()
+
+  def testInvalidFile(self):
+    f = open(self.fn,"wb")
+    f.write(b"not a rule table")
+    f.close()
+    self.assertRaises(ValueError,SearchAndReplace.RuleTable,self.fn)
+
+  def testReplaceOrder(self):
+    # Pairs are applied in order, and later pairs see the text from earlier
+    # ones, as with a dictionary.
+    for pairs in ([('a','b'),('b','c'),('c','a')],[('a','aa'),('a','b')],
+                  [('x','ab'),('ba','-'),('','.')]):
+      SearchAndReplace.WriteRuleTable(self.fn,pairs)
+      table = SearchAndReplace.RuleTable(self.fn)
+      for line in ('abc','xxa','',' ba x'):
+        expected = line
+        for (key,value) in pairs:
+          expected = expected.replace(key,value)
+        self.assertEqual(table.Replace(line),expected)
+      table.Close()
+
+  def testMemory(self):
+    # The pairs stay in the memory map, so replacing lines doesn't allocate
+    # memory that grows with the size of the table.
+    try:
+      import tracemalloc
+    except ImportError:
+      return
+    line = native(u'a line with key00010 and caf\xe9 in it')
+    growth = []
+    for size in (100,20000):
+      pairs = [('key%05d' % i,'value%d' % i) for i in range(size)]
+      SearchAndReplace.WriteRuleTable(self.fn,pairs)
+      table = SearchAndReplace.RuleTable(self.fn)
+      r = SearchAndReplace.SimpleReplacer(table)
+      tracemalloc.start()
+      for i in range(10):
+        self.assertEqual(r(line),native(u'a line with value10 and caf\xe9 in it'))
+      self.assertTrue('key%05d' % (size-1) in table)
+      current,peak = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+      growth.append(peak)
+      table.Close()
+    self.assertTrue(growth[1] < 64*1024,growth)
+    self.assertTrue(growth[1] < 2*growth[0] + 4096,growth)
+
+  def testNonAscii(self):
+    r = SearchAndReplace.SimpleReplacer(self.table)
+    line = r(native(u'Robert caf\xe9 and I'))
+    self.assertEqual(line,'Bob cafe and me')
+    self.assertTrue(type(line) is str)
+    self.assertTrue(type(r('Robert and I')) is str)
+    line = native(u'Robert \xe9 caf\xe9\n')
+    s = SearchAndReplace.SearchAndReplace([r])
+    self.assertEqual(s.__ReplaceLine__(line,1),native(u'Bob \xe9 cafe\n'))
+    self.assertEqual(s.DoReplaceStr(line),native(u'Bob \xe9 cafe\n'))
+
+  def testReplacers(self):
+    r = SearchAndReplace.SimpleReplacer(self.table)
+    self.assertEqual("Bob and me",r("Robert and I"))
+    r.AddPair("William","Bill")
+    self.assertEqual("Bob and Bill",r("Robert and William"))
+
+    SearchAndReplace.WriteRuleTable(self.fn,{"(b..)":r"_\1_"})
+    table = SearchAndReplace.RuleTable(self.fn)
+    r = SearchAndReplace.RegexReplacer(table)
+    self.assertEqual("_bob_ is a _bot_.",r("bob is a bot."))
+    table.Close()
+
 class TestReplacerSwitch(unittest.TestCase):
 
   def setUp(self):
@@ -168,12 +434,128 @@ class TestReplacerSwitch(unittest.TestCase):
     self.assertEqual(self.switch(line2),line2)
     self.assertEqual(self.switch(line),'Michael and Bob were with William')
 
+  def testReplaceMany(self):
+    # Switch state depends on the order of the lines, so repeated values must
+    # not be merged.
+    line = 'Michael and Robert'
+    values = [line,'switch a',line,'switch b',line]
+    self.assertEqual(self.switch.ReplaceMany(values), \
+          ['Mike and Robert','switch a','Michael and Bob','switch b',line])
+
 class TestGlobalFunctions(unittest.TestCase):
 
   def testcompile(self):
     p = SearchAndReplace.compile("(a.)(b.)",{1:"test"})
     self.assertTrue(isinstance(p,SearchAndReplace.PatternDecorator))
 
+class FakeMatch:
+  """
+  Stands in for the match objects of a regex engine other than re.
+  """
+
+  def __init__(self,match):
+    self.match = match
+
+  def __getattr__(self,name):
+    return getattr(self.match,name)
+
+class FakePattern:
+  """
+  Stands in for the pattern objects of a regex engine other than re.
+  """
+
+  def __init__(self,pattern):
+    self.pattern = pattern
+
+  def __getattr__(self,name):
+    return getattr(self.pattern,name)
+
+  def finditer(self,string,*args):
+    for match in self.pattern.finditer(string,*args):
+      yield FakeMatch(match)
+
+  def search(self,string,*args):
+    match = self.pattern.search(string,*args)
+    if match is not None: return FakeMatch(match)
+
+def fake_backend(fallback=False):
+  """
+  Create a backend module that refuses back references. With fallback set it
+  compiles them with re instead, as some re2 bindings do.
+  """
+  import re, types
+  module = types.ModuleType("fakere")
+  def compile(pattern):
+    if "\\1" in pattern:
+      if fallback: return re.compile(pattern)
+      raise ValueError("Back references are not supported")
+    return FakePattern(re.compile(pattern))
+  module.compile = compile
+  return module
+
+class TestRegexBackend(unittest.TestCase):
+
+  def tearDown(self):
+    SearchAndReplace.SetRegexBackend('re')
+
+  def testSetRegexBackend(self):
+    import re
+    SearchAndReplace.SetRegexBackend(('re2','re'))
+    self.assertTrue(SearchAndReplace.GetRegexBackend() is re)
+    self.assertEqual(SearchAndReplace.compile("(b.)",{1:"x"}).sub(r"\1","ab1"),"ax")
+    self.assertRaises(ValueError,SearchAndReplace.SetRegexBackend,('re','unknown'))
+    self.assertRaises(ValueError,SearchAndReplace.SetRegexBackend,object())
+    if not SearchAndReplace.IsBackendAvailable('re2'):
+      self.assertRaises(ImportError,SearchAndReplace.SetRegexBackend,('re2',))
+    # A rejected backend leaves the default unchanged.
+    self.assertTrue(SearchAndReplace.GetRegexBackend() is re)
+
+  def testFakeBackend(self):
+    # The groupmap overrides must work with the match objects of another
+    # engine, including the re template expansion.
+    p = SearchAndReplace.PatternDecorator("(a.)(b.)",{1:"x"},fake_backend())
+    self.assertTrue(isinstance(p._pattern,FakePattern))
+    self.assertEqual(p.sub(r"\2\1","za1b2z"),"zb2xz")
+    self.assertEqual(p.search("za1b2z").expand(r"<\1>"),"<x>")
+    p = SearchAndReplace.compile(r"(a.)\1",{1:"x"},(fake_backend(),'re'))
+    self.assertFalse(isinstance(p._pattern,FakePattern))
+    self.assertEqual(p.sub(r"<\1>","za1a1z"),"z<x>z")
+
+  def testBackendImportedOnce(self):
+    import re
+    SearchAndReplace.IsBackendAvailable('re2')
+    self.assertTrue('re2' in SearchAndReplace._backend_modules)
+    SearchAndReplace.GetRegexBackend('re')
+    self.assertTrue(SearchAndReplace._backend_modules['re'] is re)
+
+  def testCompatibleFallback(self):
+    patterns = ["(a.)(b.)",r"(a)\1"]
+    self.assertEqual(SearchAndReplace.CompatiblePatterns(patterns,fake_backend()),patterns[:1])
+    self.assertEqual(SearchAndReplace.CompatiblePatterns(patterns,fake_backend(True)),patterns[:1])
+
+  def testGetRegexBackend(self):
+    import re
+    self.assertTrue(SearchAndReplace.GetRegexBackend() is re)
+    self.assertTrue(SearchAndReplace.GetRegexBackend(re) is re)
+    self.assertRaises(ValueError,SearchAndReplace.GetRegexBackend,'unknown')
+    self.assertRaises(ValueError,SearchAndReplace.SetRegexBackend,'unknown')
+
+  def testCompatiblePatterns(self):
+    patterns = ["(a.)(b.)",r"(a)\1","(b."]
+    self.assertEqual(SearchAndReplace.CompatiblePatterns(patterns,'re'),patterns[:2])
+    if not SearchAndReplace.IsBackendAvailable('re2'):
+      self.assertEqual(SearchAndReplace.CompatiblePatterns(patterns,'re2'),[])
+
+  def testBackendFallback(self):
+    # The first installed backend that can compile the pattern is used, and
+    # the groupmap still overrides the group values.
+    p = SearchAndReplace.compile(r"(a.)\1",{1:"x"},('re2','regex','re'))
+    self.assertEqual(p.sub(r"<\1>","za1a1z"),"z<x>z")
+
+  def testRegexReplacerBackend(self):
+    r = SearchAndReplace.RegexReplacer({"(b..)":r"_\1_"},('re2','re'))
+    self.assertEqual("_bob_ is a _bot_.",r("bob is a bot."))
+
 class TestPatternDecorator(unittest.TestCase):
 
   def setUp(self):